@@ -1,28 +1,83 @@
 # Lightweight logical algebra tree and pretty printer
 
+import sys
 from dataclasses import dataclass, field
-from typing import List, Optional, Any, Dict, Set
+from typing import List, Optional, Any, Dict, Set, Tuple, Callable, Iterator, NamedTuple
 
-@dataclass
+# props carried for the rules only (e.g. the sqlglot AST of "pred"); not rendered or hashed
+_HIDDEN_PROPS = frozenset({"pred_ast"})
+
+# slots: trees are built and copied node by node, so no per-instance __dict__
+@dataclass(slots=True)
 class Node:
     op: str
     children: List["Node"] = field(default_factory=list)
     props: Dict[str, Any] = field(default_factory=dict)
+    # derived state, invalidated by set_child; not part of the constructor or equality
+    _aliases_cache: Optional[frozenset] = field(default=None, init=False, repr=False, compare=False)
+    _sig_hash: Optional[int] = field(default=None, init=False, repr=False, compare=False)
+
+    def set_child(self, i: int, child: "Node") -> None:
+        # structural mutation: drop cached derived state
+        self.children[i] = child
+        self._aliases_cache = None
+        self._sig_hash = None
+
+    # relation aliases reachable below this node (cached until set_child)
+    def aliases(self) -> frozenset:
+        if self._aliases_cache is None:
+            # children come out of postorder first; already-cached subtrees are not re-entered
+            for n in postorder(self, prune=lambda m: m._aliases_cache is not None):
+                if n.op == "Scan":
+                    n._aliases_cache = frozenset((n.props["alias"],))
+                else:
+                    n._aliases_cache = frozenset().union(*(c._aliases_cache for c in n.children))
+        return self._aliases_cache
+
+    def shallow_copy(self) -> "Node":
+        # new node sharing the same children (no subtree copying)
+        return Node(self.op, list(self.children), dict(self.props))
 
     def copy(self) -> "Node":
-        import copy
-        return copy.deepcopy(self)
+        # structural copy: fresh nodes and prop containers, str atoms and pred_ast shared;
+        # a subplan shared in this tree is shared in the copy too
+        copies: Dict[int, Node] = {}
+        for n in postorder(self, prune=lambda m: id(m) in copies):
+            if id(n) not in copies:
+                copies[id(n)] = Node(n.op, [copies[id(c)] for c in n.children], _copy_props(n.props))
+        return copies[id(self)]
+
+    # structural identity: equal trees have equal ops, rendered props and children.
+    # Both are O(subtree size), like a nested tuple: rules edit nodes deep in the tree, which
+    # leaves ancestors' cached _sig_hash stale, so __hash__ recomputes (and refreshes) every
+    # descendant's hash, and __eq__ walks both trees.
+    def __hash__(self) -> int:
+        return fresh_sig_hash(self)
+
+    def __eq__(self, other: object) -> bool:
+        if self is other:
+            return True
+        if not isinstance(other, Node):
+            return NotImplemented
+        stack = [(self, other)]
+        while stack:
+            a, b = stack.pop()
+            if a is b:
+                continue
+            if a.op != b.op or len(a.children) != len(b.children) or _visible_props(a) != _visible_props(b):
+                return False
+            stack.extend(zip(a.children, b.children))
+        return True
 
     # preorder textual rendering
     def render(self, indent: int = 0) -> str:
-        pad = "  " * indent
-        head = f"{pad}{self.op}{(' ' + str(self.props)) if self.props else ''}"
-        if not self.children:
-            return head
-        return head + "\n" + "\n".join(c.render(indent + 1) for c in self.children)
+        def head(n: "Node", depth: int) -> str:
+            props = _visible_props(n)
+            return f"{'  ' * (indent + depth)}{n.op}{(' ' + str(props)) if props else ''}"
+        return "\n".join(head(n, d) for n, d in preorder(self))
 
-    # utility to collect needed attributes bottom-up
-    def needed_attrs(self) -> Set[str]:
+    # attributes referenced by this node alone
+    def needed_attrs_local(self) -> Set[str]:
         # naive: union of projections, predicates, group/order cols
         need = set()
         if "attrs" in self.props:
@@ -30,12 +85,112 @@ class Node:
         for k in ["pred_attrs", "group_by", "order_by", "join_keys_left", "join_keys_right"]:
             if k in self.props and self.props[k]:
                 need |= set(self.props[k])
-        for ch in self.children:
-            need |= ch.needed_attrs()
         return need
 
+    # utility to collect needed attributes of the whole subtree
+    def needed_attrs(self) -> Set[str]:
+        need = set()
+        stack = [self]
+        while stack:
+            n = stack.pop()
+            need |= n.needed_attrs_local()
+            stack.extend(n.children)
+        return need
+
+def _visible_props(n: Node) -> Dict[str, Any]:
+    return {k: v for k, v in n.props.items() if k not in _HIDDEN_PROPS}
+
+def _copy_props(props: Dict[str, Any]) -> Dict[str, Any]:
+    # one level down: lists (attrs, keys) and dicts (aggs) hold only strings
+    return {k: list(v) if isinstance(v, list) else dict(v) if isinstance(v, dict) else v
+            for k, v in props.items()}
+
+# Iterative traversals (explicit stacks, no Python recursion on deep join trees)
+def preorder(root: Node) -> Iterator[Tuple[Node, int]]:
+    # yields (node, depth), children left to right
+    stack = [(root, 0)]
+    while stack:
+        n, d = stack.pop()
+        yield n, d
+        stack.extend((c, d + 1) for c in reversed(n.children))
+
+def postorder(root: Node, prune: Optional[Callable[[Node], bool]] = None) -> Iterator[Node]:
+    # children before parents, left to right; nodes matching prune are skipped with their subtree
+    if prune is not None and prune(root):
+        return
+    stack = [(root, False)]
+    while stack:
+        n, expanded = stack.pop()
+        if expanded:
+            yield n
+            continue
+        stack.append((n, True))
+        for c in reversed(n.children):
+            if prune is None or not prune(c):
+                stack.append((c, False))
+
+class Transformed(NamedTuple):
+    node: Node
+    changed: bool
+
+def rewrite_children(node: Node, f: Callable[[Node], Transformed]) -> bool:
+    # apply f to each child, reassigning only the pointers whose subtree changed
+    changed = False
+    for i, c in enumerate(node.children):
+        t = f(c)
+        if t.changed:
+            node.set_child(i, t.node)
+            changed = True
+    return changed
+
+def mutate(node: Node, fn: Callable[[Node], Transformed]) -> Transformed:
+    # bottom-up in-place rewrite: fn(node) -> Transformed(new_node, changed).
+    # A child pointer is only reassigned when its subtree actually changed, so
+    # untouched subtrees are shared by reference. Shared subplans are visited once.
+    done: Dict[int, Tuple[Node, Transformed]] = {}  # id -> (node kept alive, result)
+    def visit(n: Node) -> Transformed:
+        hit = done.get(id(n))
+        if hit is not None:
+            return hit[1]
+        changed = rewrite_children(n, visit)
+        t = fn(n)
+        t = Transformed(t.node, changed or t.changed)
+        done[id(n)] = (n, t)
+        return t
+    return visit(node)
+
+def signature(node: Node) -> bytes:
+    # canonical form "op|props|child hash|..." emitted into a single buffer;
+    # children contribute their cached hash, so this is O(1) per node
+    buf = bytearray(node.op.encode())
+    buf += b"|"
+    # dict values (aggs) are sorted too: equal dicts in another insertion order hash the same
+    props = sorted(((k, tuple(sorted(v.items())) if isinstance(v, dict) else v)
+                    for k, v in node.props.items() if k not in _HIDDEN_PROPS), key=lambda kv: kv[0])
+    buf += repr(props).encode()
+    for c in node.children:
+        buf += b"|"
+        buf += str(sig_hash(c)).encode()
+    return bytes(buf)
+
+def sig_hash(node: Node) -> int:
+    # cached per node; only set_child on the node itself invalidates it, so
+    # callers that mutate deeper must recompute bottom-up (see fresh_sig_hash)
+    if node._sig_hash is None:
+        node._sig_hash = hash(signature(node))
+    return node._sig_hash
+
+def fresh_sig_hash(root: Node) -> int:
+    # recompute the cached hashes of the whole subtree bottom-up, ignoring stale ones
+    for n in postorder(root):
+        n._sig_hash = None
+        n._sig_hash = hash(signature(n))
+    return root._sig_hash
+
 def leaf_scan(relation: str, alias: Optional[str] = None) -> Node:
-    return Node("Scan", props={"relation": relation, "alias": alias or relation})
+    # interned: aliases are compared and hashed in every alias-set lookup
+    relation = sys.intern(relation)
+    return Node("Scan", props={"relation": relation, "alias": sys.intern(alias) if alias else relation})
 
 def sigma(pred: str, attrs: List[str]) -> Node:
     return Node("Select", props={"pred": pred, "pred_attrs": attrs})
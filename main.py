@@ -9,12 +9,12 @@ def run(sql: str, trace: bool=True, unnest: bool=True, emit_sql: str=None):
     if unnest:
         sql = unnest_exists_in(sql)
     root = parse_sql_to_tree(sql)
-    steps = []
+    steps = [] if trace else None  # no trace -> fused single-shot pipeline
     final = optimize_pipeline(root, steps)
-    for name, tree in steps:
+    for name, render in steps or []:
         print("="*80)
         print(name)
-        print(tree.render())
+        print(render())
     if emit_sql:
         out_sql = sql_from_tree(final)
         with open(emit_sql, "w") as f:
@@ -28,6 +28,7 @@ def main(argv=None):
     p.add_argument("--inline", action="store_true", help="Treat --sql as inline SQL text")
     p.add_argument("--no-unnest", action="store_true")
     p.add_argument("--no-sqlout", action="store_true")
+    p.add_argument("--no-trace", action="store_true", help="Skip the rule-by-rule trace (runs the fused pipeline)")
     p.add_argument("--emit-sql", default="optimized.sql")
     args = p.parse_args(argv)
 
@@ -37,7 +38,7 @@ def main(argv=None):
         with open(args.sql, "r") as f:
             sql_text = f.read()
 
-    return run(sql_text, trace=True, unnest=not args.no_unnest, emit_sql=None if args.no_sqlout else args.emit_sql)
+    return run(sql_text, trace=not args.no_trace, unnest=not args.no_unnest, emit_sql=None if args.no_sqlout else args.emit_sql)
 
 if __name__ == "__main__":
     raise SystemExit(main())
@@ -1,20 +1,28 @@
 # Front-end: Parse SQL to canonical logical tree using sqlglot
+import sys
+import functools
 from typing import List, Tuple, Dict, Any
 import sqlglot
 from sqlglot import exp
 from .logical_tree import Node, leaf_scan, sigma, pi, join, group, having, order
 
 def _col_attrs(expr: exp.Expression) -> List[str]:
-    # return ["alias.col" or "col"]
-    cols = []
+    # return ["alias.col" or "col"]; interned, since rules do set/dict lookups on them
+    seen = set()
+    cols = []  # dedupe preserve order
     for e in expr.find_all(exp.Column):
-        if e.table:
-            cols.append(f"{e.table}.{e.name}")
-        else:
-            cols.append(e.name)
-    return list(dict.fromkeys(cols))  # dedupe preserve order
+        key = f"{e.table}.{e.name}" if e.table else e.name
+        if key not in seen:
+            seen.add(key)
+            cols.append(sys.intern(key))
+    return cols
 
 def parse_sql_to_tree(sql: str) -> Node:
+    # the rules rewrite trees in place, so each caller gets a fresh copy of the cached tree
+    return _parse_cached(sql).copy()
+
+@functools.lru_cache(maxsize=512)
+def _parse_cached(sql: str) -> Node:
     q = sqlglot.parse_one(sql)
     assert isinstance(q, (exp.Select, exp.Subquery, exp.Union)), "Only SELECT supported"
     if isinstance(q, exp.Subquery):
@@ -26,7 +34,7 @@ def parse_sql_to_tree(sql: str) -> Node:
     from_expr = q.args.get("from")
     assert from_expr, "Query must have FROM"
     sources = []  # List[Node]
-    join_preds: List[Tuple[str, List[str]]] = []
+    join_preds: List[Tuple[str, List[str], exp.Expression]] = []
     if isinstance(from_expr, exp.From):
         # collect base tables and explicit joins
         base = None
@@ -51,7 +59,7 @@ def parse_sql_to_tree(sql: str) -> Node:
             on = j.args.get("on")
             if on:
                 pred_sql = on.sql()
-                join_preds.append((pred_sql, []))  # attrs fill later
+                join_preds.append((pred_sql, [], on))  # attrs fill later
             # canonical: Cross product first
             cur = join("Cross", None, cur, right)
         sources.append(cur)
@@ -60,7 +68,7 @@ def parse_sql_to_tree(sql: str) -> Node:
 
     # WHERE: break into conjuncts, build cascade of selections
     where = q.args.get("where")
-    where_preds: List[Tuple[str, List[str]]] = []
+    where_preds: List[Tuple[str, List[str], exp.Expression]] = []
     if where:
         cond = where.this
         conjuncts = list(cond.flatten() if isinstance(cond, exp.And) else [cond])
@@ -71,7 +79,7 @@ def parse_sql_to_tree(sql: str) -> Node:
             return [node]
         conjuncts = split_and(cond)
         for c in conjuncts:
-            where_preds.append((c.sql(), _col_attrs(c)))
+            where_preds.append((c.sql(), _col_attrs(c), c))
 
     # SELECT list: split into plain attrs and aggregates
     select_attrs: List[str] = []
@@ -97,10 +105,12 @@ def parse_sql_to_tree(sql: str) -> Node:
         for g in gb.expressions:
             group_by_cols += _col_attrs(g) or [g.sql()]
     having_pred = None
+    having_ast = None
     having_attrs: List[str] = []
     if hv := q.args.get("having"):
-        having_pred = hv.this.sql()
-        having_attrs = _col_attrs(hv.this)
+        having_ast = hv.this
+        having_pred = having_ast.sql()
+        having_attrs = _col_attrs(having_ast)
 
     # ORDER BY
     order_cols = []
@@ -111,12 +121,13 @@ def parse_sql_to_tree(sql: str) -> Node:
     # Build canonical tree:
     # FROM (cross-products) -> selections (WHERE + collected join on) -> group -> having -> project -> order
     root = sources[0]
-    for pred, attrs in where_preds + [(jp, []) for jp, _ in join_preds]:
-        root = Node("Select", children=[root], props={"pred": pred, "pred_attrs": attrs})
+    # pred_ast keeps the sqlglot expression so rules need not re-parse the text
+    for pred, attrs, ast in where_preds + [(jp, [], ja) for jp, _, ja in join_preds]:
+        root = Node("Select", children=[root], props={"pred": pred, "pred_attrs": attrs, "pred_ast": ast})
     if group_by_cols or aggs:
         root = Node("Group", children=[root], props={"group_by": group_by_cols, "aggs": aggs})
         if having_pred:
-            root = Node("Having", children=[root], props={"pred": having_pred, "pred_attrs": having_attrs})
+            root = Node("Having", children=[root], props={"pred": having_pred, "pred_attrs": having_attrs, "pred_ast": having_ast})
     # Projection (SELECT list). If SELECT *, leave empty to be resolved in projection pushdown
     root = Node("Project", children=[root], props={"attrs": select_attrs})
     if order_cols:
@@ -1,149 +1,243 @@
 # Heuristic rules and optimizer pipeline
 from __future__ import annotations
-from typing import List, Tuple, Dict, Any, Optional
-from .logical_tree import Node, pi, sigma, join
+import re
+import sys
+from typing import List, Tuple, Dict, Any, Optional, Callable
+import sqlglot
+from sqlglot import exp
+from sqlglot.optimizer.normalize import normalize
+from .logical_tree import Node, Transformed, mutate, rewrite_children, postorder, signature, sig_hash, pi, sigma, join
 
 def _collect_scans(n: Node) -> List[Node]:
-    if n.op == "Scan":
-        return [n]
-    out = []
-    for c in n.children:
-        out += _collect_scans(c)
-    return out
+    return [m for m in postorder(n) if m.op == "Scan"]
+
+def _pred_ast(node: Node) -> Optional[exp.Expression]:
+    # sqlglot AST of the node's predicate; the front-end stores it, hand-built nodes are parsed once
+    ast = node.props.get("pred_ast")
+    if ast is None and node.props.get("pred"):
+        ast = node.props["pred_ast"] = sqlglot.parse_one(node.props["pred"])
+    return ast
+
+def _split_conjuncts(node: Node) -> Transformed:
+    # Select(p1 AND p2 ...) -> Select(p1) over Select(p2) ...
+    if node.op == "Select" and isinstance(ast := _pred_ast(node), exp.And):
+        cur = node.children[0]
+        for p in list(ast.flatten())[::-1]:
+            cur = Node("Select", children=[cur], props={"pred": p.sql(), "pred_attrs": node.props.get("pred_attrs",[]), "pred_ast": p})
+        return Transformed(cur, True)
+    return Transformed(node, False)
+
+def _joinize_node(node: Node) -> Transformed:
+    # Select(A.x = B.y) directly over Cross -> Join with keys
+    def qualified(e: exp.Expression) -> bool:
+        return isinstance(e, exp.Column) and bool(e.table)
+
+    if node.op == "Select" and node.children[0].op == "Cross":
+        ast = _pred_ast(node)
+        if isinstance(ast, exp.EQ) and qualified(ast.left) and qualified(ast.right):
+            # build Join
+            left, right = node.children[0].children
+            return Transformed(Node("Join", children=[left, right],
+                                    props={"on": node.props.get("pred",""),
+                                           "join_keys_left": [f"{ast.left.table}.{ast.left.name}"],
+                                           "join_keys_right": [f"{ast.right.table}.{ast.right.name}"]}), True)
+    return Transformed(node, False)
+
+def _having_to_where_node(node: Node) -> Transformed:
+    # Having without aggregates -> Select below its Group
+    if node.op == "Having":
+        ast = _pred_ast(node)
+        if ast is not None and ast.find(exp.Sum, exp.Count, exp.Avg, exp.Min, exp.Max):
+            return Transformed(node, False)
+        # insert as Select below Group
+        g = node.children[0]
+        sel = Node("Select", children=[g.children[0]], props=node.props)
+        g.set_child(0, sel)
+        return Transformed(g, True)  # drop Having
+    return Transformed(node, False)
+
+def _apply(rules, node: Node) -> Transformed:
+    # run node-local rules in order on one node
+    changed = False
+    for f in rules:
+        t = f(node)
+        if t.changed:
+            node, changed = t.node, True
+    return Transformed(node, changed)
+
+class FusedRewriter:
+    """Selection pushdown walk that also applies node-local rules on the way.
+
+    ``before`` rules run on a node when the walk first reaches it, so they see
+    it before pushdown does. With no rules this is plain selection pushdown.
+    """
+
+    def __init__(self, before=()):
+        self.before = tuple(before)
+
+    def visit(self, node: Node) -> Transformed:
+        # before rules run once per node, on first entry; children are settled before the node
+        pre = _apply(self.before, node)
+        node = pre.node
+        changed = rewrite_children(node, self.visit) or pre.changed
+        if node.op != "Select":
+            return Transformed(node, changed)
+        t = self._sink(node)
+        return Transformed(t.node, t.changed or changed)
+
+    def _sink(self, node: Node) -> Transformed:
+        # move a Select whose subtree is already settled down through joins/crosses;
+        # a reattached Select only sinks further, its new child is not walked again
+        child = node.children[0]
+        # find involved aliases by looking at pred_attrs "A.col" -> "A"
+        involved = {a.split(".")[0] for a in node.props.get("pred_attrs",[]) if "." in a}
+        # Try pushing into left or right if child is a join/cross and only one side referenced
+        if involved and child.op in {"Cross", "Join"}:
+            left, right = child.children
+            if involved <= left.aliases():
+                node.set_child(0, left)
+                child.set_child(0, self._sink(node).node)  # reattach
+                return Transformed(child, True)
+            if involved <= right.aliases():
+                node.set_child(0, right)
+                child.set_child(1, self._sink(node).node)
+                return Transformed(child, True)
+        return Transformed(node, False)  # keep at current level (could be constant filter)
+
+    def run(self, root: Node) -> Node:
+        """Whole pipeline with compatible rules fused into shared walks (no trace).
+
+        Produces the same tree as the step-by-step pipeline. Joinize rides along
+        with projection pushdown rather than selection pushdown: a Select turned
+        into a Join early would let the Selects above it be pushed further than
+        the traced pipeline pushes them.
+        """
+        root = FusedRewriter(before=[_split_conjuncts]).visit(root).node
+        root = _projection_pushdown(root, before=[_joinize_node])
+        root = share_common_subplans(root)
+        root = reorder_joins(root)
+        return _dedup_selections(root, before=[_having_to_where_node])
 
 def breakup_conjuncts(n: Node) -> Node:
-    # already done in front-end for WHERE; here we split Select nodes that have AND textuals (best-effort)
-    import re
-    def helper(node: Node) -> Node:
-        if node.op == "Select" and " AND " in node.props.get("pred",""):
-            parts = re.split(r"\s+AND\s+", node.props["pred"])
-            cur = node.children[0]
-            for p in parts[::-1]:
-                cur = Node("Select", children=[cur], props={"pred": p, "pred_attrs": node.props.get("pred_attrs",[])})
-            return cur
-        node.children = [helper(c) for c in node.children]
-        return node
-    return helper(n)
+    # already done in front-end for WHERE; here we split Select nodes whose predicate is still a conjunction
+    return mutate(n, _split_conjuncts).node
 
 def selection_pushdown(n: Node) -> Node:
     # push Select as low as possible when predicate touches only one relation alias
-    def aliases(node: Node) -> set:
-        if node.op == "Scan":
-            return {node.props["alias"]}
-        s = set()
-        for c in node.children:
-            s |= aliases(c)
-        return s
-
-    def helper(node: Node) -> Node:
-        if node.op == "Select":
-            child = helper(node.children[0])
-            node.children[0] = child
-            # find involved aliases by looking at pred_attrs "A.col" -> "A"
-            involved = {a.split(".")[0] for a in node.props.get("pred_attrs",[]) if "." in a}
-            if not involved:
-                return node  # keep at current level (could be constant filter)
-            # Try pushing into left or right if child is a join/cross and only one side referenced
-            if child.op in {"Cross", "Join"}:
-                left, right = child.children
-                la, ra = aliases(left), aliases(right)
-                if involved <= la:
-                    node.children[0] = left
-                    child.children[0] = helper(node)  # reattach
-                    return child
-                if involved <= ra:
-                    node.children[0] = right
-                    child.children[1] = helper(node)
-                    return child
-        else:
-            node.children = [helper(c) for c in node.children]
-        return node
-    return helper(n)
+    return FusedRewriter().visit(n).node
 
 def joinize(n: Node) -> Node:
     # Convert Select above Cross into Join when predicate is an equality between attrs from both sides
-    import re
-    def helper(node: Node) -> Node:
-        node.children = [helper(c) for c in node.children]
-        if node.op == "Select" and node.children[0].op == "Cross":
-            pred = node.props.get("pred","")
-            m = re.match(r"\s*([\w]+)\.([\w]+)\s*=\s*([\w]+)\.([\w]+)\s*$", pred)
-            if m:
-                # build Join
-                left, right = node.children[0].children
-                return Node("Join", children=[left, right],
-                            props={"on": pred,
-                                   "join_keys_left": [f"{m.group(1)}.{m.group(2)}"],
-                                   "join_keys_right": [f"{m.group(3)}.{m.group(4)}"]})
-        return node
-    return helper(n)
+    return mutate(n, _joinize_node).node
+
+def _agg_attrs(node: Node) -> set:
+    # attrs mentioned in a Group's aggs (simple column refs inside agg)
+    agg_attrs = set()
+    for v in node.props.get("aggs",{}).values():
+        # very simple parse: look for A.B tokens
+        for tok in v.replace("`","").replace("("," ").replace(")"," ").replace(","," ").split():
+            if "." in tok:
+                agg_attrs.add(tok)
+    return agg_attrs
 
 def projection_pushdown(n: Node) -> Node:
     # compute needed attributes per subtree and insert Projects
-    def helper(node: Node, needed: set) -> Node:
+    return _projection_pushdown(n)
+
+def _projection_pushdown(n: Node, before=()) -> Node:
+
+    # one walk up front: group every attr string the tree mentions by its alias,
+    # so per-node filtering is a frozenset intersection instead of a split per attr
+    by_alias: Dict[str, set] = {}
+    stack = [n]
+    while stack:
+        node = stack.pop()
+        attrs = node.needed_attrs_local() | (_agg_attrs(node) if node.op == "Group" else set())
+        if before and node.op == "Select" and isinstance(ast := _pred_ast(node), exp.EQ):
+            # a hook may turn this Select into a Join keyed on the two sides of the equality
+            attrs |= {f"{c.table}.{c.name}" for c in (ast.left, ast.right) if isinstance(c, exp.Column) and c.table}
+        for a in attrs:
+            by_alias.setdefault(sys.intern(a.partition(".")[0]), set()).add(a)
+        stack.extend(node.children)
+    alias_index: Dict[str, frozenset] = {k: frozenset(v) for k, v in by_alias.items()}
+    side_index: Dict[frozenset, frozenset] = {}
+
+    def attrs_of(aliases: frozenset) -> frozenset:
+        # all known attrs belonging to any of the given aliases
+        out = side_index.get(aliases)
+        if out is None:
+            out = side_index[aliases] = frozenset().union(*(alias_index.get(a, ()) for a in aliases))
+        return out
+
+    def helper(node: Node, needed: frozenset) -> Transformed:
+        pre = _apply(before, node)
+        if pre.changed:
+            return Transformed(helper(pre.node, needed).node, True)
         if node.op == "Scan":
             # Limit to needed attrs of this relation if not SELECT *
             if "*" in needed or not needed:
-                return node
-            attrs = [a for a in needed if a.split(".")[0] == node.props["alias"]]
+                return Transformed(node, False)
+            attrs = needed & alias_index.get(node.props["alias"], frozenset())
             if attrs:
-                return Node("Project", children=[node], props={"attrs": sorted(attrs)})
-            return node
+                return Transformed(Node("Project", children=[node], props={"attrs": sorted(attrs)}), True)
+            return Transformed(node, False)
         if node.op in {"Select","Having"}:
-            pred_attrs = set(node.props.get("pred_attrs",[]))
-            child = helper(node.children[0], needed | pred_attrs)
-            node.children[0] = child
-            return node
+            child_needed = needed | frozenset(node.props.get("pred_attrs",[]))
+            return Transformed(node, rewrite_children(node, lambda c: helper(c, child_needed)))
         if node.op in {"Join","Cross"}:
             left, right = node.children
             # split needed by side + join keys
-            keys = set(node.props.get("join_keys_left",[])) | set(node.props.get("join_keys_right",[]))
-            left_needed = {a for a in needed if a.split(".")[0] in _aliases(left)} | {k for k in keys if k.split(".")[0] in _aliases(left)}
-            right_needed = {a for a in needed if a.split(".")[0] in _aliases(right)} | {k for k in keys if k.split(".")[0] in _aliases(right)}
-            node.children[0] = helper(left, left_needed)
-            node.children[1] = helper(right, right_needed)
-            return node
+            wanted = needed | frozenset(node.props.get("join_keys_left",[])) | frozenset(node.props.get("join_keys_right",[]))
+            left_needed = wanted & attrs_of(left.aliases())
+            right_needed = wanted & attrs_of(right.aliases())
+            tl, tr = helper(left, left_needed), helper(right, right_needed)
+            if tl.changed:
+                node.set_child(0, tl.node)
+            if tr.changed:
+                node.set_child(1, tr.node)
+            return Transformed(node, tl.changed or tr.changed)
         if node.op == "Group":
-            gb = set(node.props.get("group_by",[]))
-            # Collect attrs mentioned in aggs as well (simple column refs inside agg)
-            agg_attrs = set()
-            for v in node.props.get("aggs",{}).values():
-                # very simple parse: look for A.B tokens
-                for tok in v.replace("`","").replace("("," ").replace(")"," ").replace(","," ").split():
-                    if "." in tok:
-                        agg_attrs.add(tok)
-            child_needed = gb | agg_attrs
-            node.children[0] = helper(node.children[0], child_needed)
-            return node
+            child_needed = frozenset(node.props.get("group_by",[])) | _agg_attrs(node)
+            return Transformed(node, rewrite_children(node, lambda c: helper(c, child_needed)))
         if node.op == "Project":
-            attrs = set(node.props.get("attrs",[]))
+            attrs = frozenset(node.props.get("attrs",[]))
             # if SELECT * -> push needed from parent instead
             attrs = needed if ("*" in attrs or not attrs) else attrs
-            node.children[0] = helper(node.children[0], attrs)
-            return node
+            return Transformed(node, rewrite_children(node, lambda c: helper(c, attrs)))
         if node.op == "Order":
-            ob = set(node.props.get("order_by",[]))
-            node.children[0] = helper(node.children[0], needed | ob)
-            return node
+            child_needed = needed | frozenset(node.props.get("order_by",[]))
+            return Transformed(node, rewrite_children(node, lambda c: helper(c, child_needed)))
         # default
-        node.children = [helper(c, needed) for c in node.children]
-        return node
-
-    def _aliases(node: Node) -> set:
-        if node.op == "Scan":
-            return {node.props["alias"]}
-        s = set()
-        for c in node.children:
-            s |= _aliases(c)
-        return s
+        return Transformed(node, rewrite_children(node, lambda c: helper(c, needed)))
 
     # compute needed attrs from root outward: the project/ order define needs
-    needs = set()
+    needs = frozenset()
     if n.op == "Project":
-        needs = set(n.props.get("attrs",[]))
+        needs = frozenset(n.props.get("attrs",[]))
     elif n.op == "Order":
-        needs = set(n.props.get("order_by",[]))
-    return helper(n, needs)
+        needs = frozenset(n.props.get("order_by",[]))
+    return helper(n, needs).node
+
+def share_common_subplans(n: Node) -> Node:
+    # Unify structurally identical subtrees into one shared Node so later passes
+    # rewrite them once. Join/Cross are never the root of a shared subplan.
+    # Every leaf is a Scan, so identical subtrees need a repeated scan alias; front-end
+    # trees rarely have one (only anonymous subqueries), so check that first.
+    scan_aliases = [m.props["alias"] for m in postorder(n) if m.op == "Scan"]
+    if len(scan_aliases) == len(set(scan_aliases)):
+        return n
+    canon: Dict[int, Node] = {}
+    def helper(node: Node) -> Transformed:
+        changed = rewrite_children(node, helper)
+        node._sig_hash = None  # earlier passes may have mutated below this node
+        h = sig_hash(node)
+        if node.op in {"Join","Cross"}:
+            return Transformed(node, changed)
+        cur = canon.setdefault(h, node)
+        if cur is not node and signature(cur) == signature(node):
+            return Transformed(cur, True)
+        return Transformed(node, changed)
+    return helper(n).node
 
 def reorder_joins(n: Node) -> Node:
     # Greedy: collect a list of base relations with attached selections, order by (#selections desc)
@@ -154,79 +248,124 @@ def reorder_joins(n: Node) -> Node:
         else:
             acc.append(node)
 
-    def count_selections(node: Node) -> int:
-        if node.op == "Select":
-            return 1 + count_selections(node.children[0])
-        total = 0
-        for c in node.children:
-            total += count_selections(c)
-        return total
-
     def rebuild_chain(factors: List[Node]) -> Node:
         cur = factors[0]
         for nxt in factors[1:]:
             cur = Node("Join", children=[cur, nxt], props={"on": None, "join_keys_left": [], "join_keys_right": []})
         return cur
 
-    def helper(node: Node) -> Node:
+    # Selects per subtree, annotated once bottom-up (reordering moves joins, never Selects);
+    # keyed by id so the counts stay out of props, which are rendered and hashed
+    sel_count: Dict[int, int] = {}
+    for m in postorder(n, prune=lambda m: id(m) in sel_count):
+        sel_count[id(m)] = (m.op == "Select") + sum(sel_count[id(c)] for c in m.children)
+
+    def helper(node: Node) -> Transformed:
         if node.op in {"Join","Cross"}:
             factors: List[Node] = []
             collect_factors(node, factors)
-            factors = [helper(f) for f in factors]
-            factors.sort(key=count_selections, reverse=True)
-            return rebuild_chain(factors)
-        node.children = [helper(c) for c in node.children]
-        return node
+            factors = [helper(f).node for f in factors]
+            factors.sort(key=lambda f: sel_count[id(f)], reverse=True)
+            return Transformed(rebuild_chain(factors), True)
+        return Transformed(node, rewrite_children(node, helper))
 
-    return helper(n)
+    return helper(n).node
 
 def having_to_where(n: Node) -> Node:
     # If Having predicate references no aggregated expressions, move as a Select below Group
-    def helper(node: Node) -> Node:
-        if node.op == "Having":
-            pred = node.props.get("pred","")
-            # naive check: contains "(" after an aggregate name => keep in Having
-            import re
-            if re.search(r"\b(SUM|COUNT|AVG|MIN|MAX)\s*\(", pred, re.IGNORECASE):
-                node.children[0] = helper(node.children[0])
-                return node
-            child = helper(node.children[0])
-            # insert as Select below Group
-            g = child
-            sel = Node("Select", children=[g.children[0]], props=node.props)
-            g.children[0] = sel
-            return g  # drop Having
-        node.children = [helper(c) for c in node.children]
-        return node
-    return helper(n)
+    return mutate(n, _having_to_where_node).node
 
-def dedup_selections(n: Node) -> Node:
-    # Remove duplicate Select predicates in a chain
-    def helper(node: Node, seen: set) -> Node:
+_FLIPPED = {exp.GT: exp.LT, exp.LT: exp.GT, exp.GTE: exp.LTE, exp.LTE: exp.GTE}
+
+# a predicate needs CNF conversion only if it has an OR (or a NOT around one); false hits just cost time
+_MAY_NEED_CNF = re.compile(r"\b(?:OR|NOT)\b", re.IGNORECASE)
+
+def _side_sql(e: exp.Expression) -> str:
+    # SQL of a comparison side; plain columns and literals (the common case) without the generator
+    if isinstance(e, exp.Column) and not e.args.get("db") and not any(
+            i is not None and i.args.get("quoted") for i in (e.this, e.args.get("table"))):
+        return f"{e.table}.{e.name}" if e.table else e.name
+    if isinstance(e, exp.Literal) and not (e.is_string and ("'" in e.this or "\\" in e.this)):
+        return f"'{e.this}'" if e.is_string else e.this
+    return e.sql()
+
+def _canonical_pred(node: Node) -> str:
+    # order-insensitive text of a predicate: CNF, sorted AND/OR operands, sorted "=" / "<>"
+    # sides, literals moved right of < > <= >= ("1 = a.x" and "a.x = 1" give the same key)
+    def canon(e: exp.Expression) -> str:
+        if isinstance(e, (exp.And, exp.Or)):
+            op = " AND " if isinstance(e, exp.And) else " OR "
+            return "(" + op.join(sorted(canon(x) for x in e.flatten())) + ")"
+        if isinstance(e, (exp.EQ, exp.NEQ)):
+            l, r = sorted((canon(e.left), canon(e.right)))
+            return f"{l} {'=' if isinstance(e, exp.EQ) else '<>'} {r}"
+        if type(e) in _FLIPPED and isinstance(e.left, exp.Literal) and not isinstance(e.right, exp.Literal):
+            return _FLIPPED[type(e)](this=e.right.copy(), expression=e.left.copy()).sql()
+        if isinstance(e, exp.Paren):
+            return canon(e.this)
+        return _side_sql(e)
+
+    pred = node.props.get("pred","")
+    ast = _pred_ast(node)
+    if ast is None:
+        return pred
+    if _MAY_NEED_CNF.search(pred):
+        return canon(normalize(ast.copy()))
+    # already CNF, and canon does not mutate. An atom keys on its own text: the front-end
+    # and split conjuncts store "pred" as exactly the AST's SQL
+    if isinstance(ast, (exp.And, exp.Or, exp.EQ, exp.NEQ, exp.Paren)) or (
+            type(ast) in _FLIPPED and isinstance(ast.left, exp.Literal)):
+        return canon(ast)
+    return pred
+
+def _dedup_selections(n: Node, before=()) -> Node:
+    # shared subplans are rewritten once, with the predicates seen on the first path to them;
+    # later paths leave them alone, so every occurrence keeps its own Selects
+    done: Dict[int, Node] = {}
+    def helper(node: Node, seen: Dict[str, Node]) -> Transformed:
+        if id(node) in done:
+            return Transformed(node, False)
+        pre = _apply(before, node)
+        node = pre.node
+        done[id(node)] = node
         if node.op == "Select":
-            pred = node.props.get("pred","")
-            if pred in seen:
-                return helper(node.children[0], seen)
-            seen.add(pred)
-            node.children[0] = helper(node.children[0], seen)
-            return node
-        node.children = [helper(c, seen) for c in node.children]
-        return node
-    return helper(n, set())
-
-def optimize_pipeline(root: Node, trace: List[Tuple[str, Node]]) -> Node:
-    def step(name: str, f, n: Node) -> Node:
-        out = f(n)
-        trace.append((name, out))
-        return out
+            key = _canonical_pred(node)
+            if key in seen:
+                return Transformed(helper(node.children[0], seen).node, True)  # splice child up
+            seen[key] = node
+        return Transformed(node, rewrite_children(node, lambda c: helper(c, seen)) or pre.changed)
+    return helper(n, {}).node
+
+def dedup_selections(n: Node) -> Node:
+    # Remove Selects whose predicate (in canonical form) already appears above them or in an
+    # earlier branch; the first occurrence in preorder is kept
+    return _dedup_selections(n)
+
+# step-by-step pipeline used when tracing; order matters (see README)
+RULES: List[Tuple[str, Callable[[Node], Node]]] = [
+    ("BreakUpConjuncts", breakup_conjuncts),
+    ("SelectionPushdown", selection_pushdown),
+    ("JoinizeSelections", joinize),
+    ("ProjectionPushdown", projection_pushdown),
+    ("ShareCommonSubplans", share_common_subplans),
+    ("ReorderJoins", reorder_joins),
+    ("HavingToWhere", having_to_where),
+    ("DedupSelections", dedup_selections),
+]
+
+def optimize_pipeline(root: Node, trace: Optional[List[Tuple[str, Callable[[], str]]]] = None) -> Node:
+    # without a trace there is nothing to show between rules, so use the fused walks
+    if trace is None:
+        return FusedRewriter().run(root)
+
+    # Rules rewrite the tree in place, so each step records a structural copy
+    # (taken now) and defers the string rendering until the caller prints it.
+    def snapshot(name: str, n: Node) -> None:
+        trace.append((name, n.copy().render))
 
-    trace.append(("Step 0 — Canonical", root))
-    root = step("Step 1 — BreakUpConjuncts", breakup_conjuncts, root)
-    root = step("Step 2 — SelectionPushdown", selection_pushdown, root)
-    root = step("Step 3 — JoinizeSelections", joinize, root)
-    root = step("Step 4 — ProjectionPushdown", projection_pushdown, root)
-    root = step("Step 5 — ReorderJoins", reorder_joins, root)
-    root = step("Step 6 — HavingToWhere", having_to_where, root)
-    root = step("Step 7 — DedupSelections", dedup_selections, root)
-    trace.append(("Step 8 — Final", root))
+    snapshot("Step 0 — Canonical", root)
+    for i, (name, f) in enumerate(RULES, 1):
+        root = f(root)
+        snapshot(f"Step {i} — {name}", root)
+    trace.append((f"Step {len(RULES) + 1} — Final", trace[-1][1]))  # same tree as the last step
     return root
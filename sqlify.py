@@ -1,6 +1,6 @@
 # Convert a final logical tree back to SQL (best-effort)
 from __future__ import annotations
-from typing import List, Tuple
+from typing import List, Tuple, Union
 from .logical_tree import Node
 
 def sql_from_tree(n: Node) -> str:
@@ -26,27 +26,42 @@ def sql_from_tree(n: Node) -> str:
     # Pull up all selections into a WHERE
     where_preds = []
     def strip_selects(node: Node) -> Node:
-        if node.op == "Select":
-            where_preds.append(node.props.get("pred",""))
-            return strip_selects(node.children[0])
-        node.children = [strip_selects(c) for c in node.children]
-        return node
+        # preorder over (parent, index, child), splicing each Select out of its parent
+        root = node
+        stack = [(None, 0, node)]
+        while stack:
+            parent, i, cur = stack.pop()
+            orig = cur
+            while cur.op == "Select":
+                where_preds.append(cur.props.get("pred",""))
+                cur = cur.children[0]
+            if parent is None:
+                root = cur
+            elif cur is not orig:
+                parent.set_child(i, cur)
+            stack.extend((cur, j, c) for j, c in reversed(list(enumerate(cur.children))))
+        return root
     n = strip_selects(n)
 
-    # Emit FROM with joins if present
-    def emit_from(node: Node) -> str:
-        if node.op == "Scan":
-            alias = node.props.get("alias")
-            rel = node.props.get("relation")
-            return f"{rel} {alias}" if alias and alias != rel else rel
-        if node.op in {"Join","Cross"}:
-            left = emit_from(node.children[0])
-            right = emit_from(node.children[1])
-            if node.op == "Join" and node.props.get("on"):
-                return f"{left} JOIN {right} ON {node.props['on']}"
-            return f"{left}, {right}"
-        return "(SUBQ)"
-    from_sql = emit_from(n)
+    # Emit FROM with joins if present: a stack of nodes and literal pieces, written left to right into out
+    def emit_from(node: Node, out: List[str]) -> None:
+        stack: List[Union[Node, str]] = [node]
+        while stack:
+            m = stack.pop()
+            if isinstance(m, str):
+                out.append(m)
+            elif m.op == "Scan":
+                alias = m.props.get("alias")
+                rel = m.props.get("relation")
+                out.append(f"{rel} {alias}" if alias and alias != rel else rel)
+            elif m.op in {"Join","Cross"}:
+                left, right = m.children
+                if m.op == "Join" and m.props.get("on"):
+                    stack += [f" ON {m.props['on']}", right, " JOIN ", left]
+                else:
+                    stack += [right, ", ", left]
+            else:
+                out.append("(SUBQ)")
 
     # SELECT list (combine aggs)
     if not select_attrs or "*" in select_attrs:
@@ -61,14 +76,15 @@ def sql_from_tree(n: Node) -> str:
         else:
             select_list = agg_list
 
-    sql = f"SELECT {select_list}\nFROM {from_sql}"
+    parts: List[str] = ["SELECT ", select_list, "\nFROM "]
+    emit_from(n, parts)
     if where_preds:
-        sql += "\nWHERE " + " AND ".join(where_preds)
+        parts += ["\nWHERE ", " AND ".join(where_preds)]
     if group_by:
-        sql += "\nGROUP BY " + ", ".join(group_by)
+        parts += ["\nGROUP BY ", ", ".join(group_by)]
     if having:
-        sql += "\nHAVING " + having
+        parts += ["\nHAVING ", having]
     if order_by:
-        sql += "\nORDER BY " + ", ".join(order_by)
-    sql += ";"
-    return sql
+        parts += ["\nORDER BY ", ", ".join(order_by)]
+    parts.append(";")
+    return "".join(parts)
@@ -1,2 +1,104 @@
+import random
+
+from .logical_tree import Node, leaf_scan, join, preorder
+from .rules import optimize_pipeline, dedup_selections, share_common_subplans
+
 def test_placeholder():
     assert 1 + 1 == 2
+
+def _random_tree(seed: int) -> Node:
+    # Project(Order?/Having?/Group?)(Select* over a random Cross shape of scans)
+    rnd = random.Random(seed)
+    aliases = [f"t{i}" for i in range(rnd.randint(1, 6))]
+    parts = [leaf_scan(a.upper(), a) for a in aliases]
+    while len(parts) > 1:
+        i = rnd.randrange(len(parts) - 1)
+        parts[i:i + 2] = [join("Cross", None, parts[i], parts[i + 1])]
+    root = parts[0]
+
+    def atom():
+        a, b = rnd.choice(aliases), rnd.choice(aliases)
+        kind = rnd.randrange(3)
+        if kind == 0 and a != b:
+            return f"{a}.k = {b}.k", [f"{a}.k", f"{b}.k"]
+        if kind == 1:
+            return f"{a}.v > {rnd.randint(0, 3)}", [f"{a}.v"]
+        return f"{rnd.randint(0, 3)} = {a}.v", [f"{a}.v"]
+
+    for _ in range(rnd.randint(0, 8)):
+        pred, attrs = atom()
+        if rnd.random() < 0.3:
+            pred2, attrs2 = atom()
+            pred, attrs = f"{pred} AND {pred2}", attrs + attrs2
+        root = Node("Select", [root], {"pred": pred, "pred_attrs": attrs})
+    cols = [f"{a}.v" for a in aliases]
+    if rnd.random() < 0.5:
+        root = Node("Group", [root], {"group_by": cols[:1], "aggs": {"n": "COUNT(*)"}})
+        if rnd.random() < 0.5:
+            root = Node("Having", [root], {"pred": f"{cols[0]} > 1", "pred_attrs": cols[:1]})
+    root = Node("Project", [root], {"attrs": cols[:2]})
+    if rnd.random() < 0.5:
+        root = Node("Order", [root], {"order_by": cols[:1]})
+    return root
+
+def test_fused_pipeline_matches_traced():
+    for seed in range(300):
+        fused = optimize_pipeline(_random_tree(seed))
+        traced = optimize_pipeline(_random_tree(seed), [])
+        assert fused.render() == traced.render(), seed
+
+def test_trace_steps_are_snapshots():
+    # each step renders the tree as it was after that rule, not the final tree
+    steps = []
+    root = Node("Project", [join("Cross", None, leaf_scan("A", "a"), leaf_scan("B", "b"))], {"attrs": ["a.x", "b.y"]})
+    optimize_pipeline(root, steps)
+    renders = {name: render() for name, render in steps}
+    assert "Step 0 — Canonical" in renders
+    assert renders["Step 0 — Canonical"] != renders[steps[-1][0]]
+    assert "Project {'attrs': ['a.x']}" not in renders["Step 0 — Canonical"]
+    assert "Project {'attrs': ['a.x']}" in renders[steps[-1][0]]
+
+def test_dedup_matches_flipped_equality():
+    # "a.x = 1" and "1 = a.x" are the same predicate
+    root = leaf_scan("A", "a")
+    for pred in ["a.x = 1", "1 = a.x", "a.y < 2", "2 > a.y", "a.x = 2"]:
+        root = Node("Select", [root], {"pred": pred, "pred_attrs": ["a.x"]})
+    out = dedup_selections(root)
+    assert [n.props["pred"] for n, _ in preorder(out) if n.op == "Select"] == ["a.x = 2", "2 > a.y", "1 = a.x"]
+
+def test_node_equality_after_deep_edit():
+    def build(rel):
+        return Node("Project", [Node("Select", [leaf_scan(rel, "a")], {"pred": "a.x > 1", "pred_attrs": ["a.x"]})], {"attrs": ["a.x"]})
+    t, u = build("B"), build("A")
+    hash(t)  # caches hashes that the edit below leaves stale on t
+    t.children[0].set_child(0, leaf_scan("A", "a"))
+    assert t == u and hash(t) == hash(u)
+    assert t != build("B")
+
+def test_node_hash_ignores_aggs_order():
+    g1 = Node("Group", [leaf_scan("A", "a")], {"group_by": ["a.x"], "aggs": {"n": "COUNT(*)", "s": "SUM(a.y)"}})
+    g2 = Node("Group", [leaf_scan("A", "a")], {"group_by": ["a.x"], "aggs": {"s": "SUM(a.y)", "n": "COUNT(*)"}})
+    assert g1 == g2 and hash(g1) == hash(g2)
+
+def _self_join() -> Node:
+    # the same filtered subquery on both sides of a cross product
+    def side():
+        return Node("Select", [leaf_scan("subq")], {"pred": "subq.v > 1", "pred_attrs": ["subq.v"]})
+    return Node("Project", [join("Cross", None, join("Cross", None, side(), side()),
+                                 join("Cross", None, side(), side()))], {"attrs": ["subq.v"]})
+
+def test_share_common_subplans():
+    root = _self_join()
+    before = root.render()
+    root = share_common_subplans(root)
+    assert root.render() == before
+    left, right = root.children[0].children
+    assert left is not right  # Join/Cross are never shared
+    assert left.children[0] is left.children[1] is right.children[0] is right.children[1]
+
+def test_shared_subplan_keeps_its_selects():
+    # each occurrence of the subquery keeps its own filter; a filter on one join input
+    # says nothing about the other, so dedup must not drop it there
+    for trace in (None, []):
+        root = optimize_pipeline(_self_join(), trace)
+        assert root.render().count("Select {'pred': 'subq.v > 1'") == 4
@@ -4,6 +4,10 @@ from typing import Tuple, List
 import re
 from .logical_tree import Node
 
+# NOT IN / NOT EXISTS -> anti-join markers
+_NOT_IN = re.compile(r"\bNOT\s+IN\s*\(", re.IGNORECASE)
+_NOT_EXISTS = re.compile(r"\bNOT\s+EXISTS\s*\(", re.IGNORECASE)
+
 def unnest_exists_in(sql_str: str) -> str:
     """
     Best-effort textual rewrite for patterns like:
@@ -14,7 +18,10 @@ def unnest_exists_in(sql_str: str) -> str:
     """
     # Replace NOT IN / NOT EXISTS first (anti-join marker)
     s = sql_str
+    # every match contains NOT; most queries have none, so skip both scans
+    if "not" not in s.lower():
+        return s
     # No deep rewrite here; just annotate for the front-end to treat as Cross + Select and later joinize
-    s = re.sub(r"\bNOT\s+IN\s*\(", " /*ANTI_IN*/ IN (", s, flags=re.IGNORECASE)
-    s = re.sub(r"\bNOT\s+EXISTS\s*\(", " /*ANTI_EXISTS*/ EXISTS (", s, flags=re.IGNORECASE)
+    s = _NOT_IN.sub(" /*ANTI_IN*/ IN (", s)
+    s = _NOT_EXISTS.sub(" /*ANTI_EXISTS*/ EXISTS (", s)
     return s